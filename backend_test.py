@@ -1,3 +1,4 @@
+import json
 import requests
 import sys
 import time
@@ -12,7 +13,7 @@ class HarassmentDetectionAPITester:
         self.harassment_accuracy_tests = 0
         self.harassment_accuracy_passed = 0
 
-    def run_test(self, name, method, endpoint, expected_status, data=None):
+    def run_test(self, name, method, endpoint, expected_status, data=None, params=None):
         """Run a single API test"""
         url = f"{self.api_url}/{endpoint}"
         headers = {'Content-Type': 'application/json'}
@@ -23,7 +24,7 @@ class HarassmentDetectionAPITester:
         
         try:
             if method == 'GET':
-                response = requests.get(url, headers=headers, timeout=30)
+                response = requests.get(url, headers=headers, params=params, timeout=30)
             elif method == 'POST':
                 response = requests.post(url, json=data, headers=headers, timeout=30)
             elif method == 'DELETE':
@@ -116,6 +117,47 @@ class HarassmentDetectionAPITester:
                 return False, response
         return success, response
 
+    def test_streamed_message(self, content="I will hurt you tomorrow"):
+        """Test that a streamed message sends analysis events before the stored message"""
+        url = f"{self.api_url}/messages"
+        headers = {'Content-Type': 'application/json', 'Accept': 'text/event-stream'}
+
+        self.tests_run += 1
+        print(f"\n🔍 Testing Streamed Message: '{content}'...")
+        print(f"   URL: {url}")
+
+        events = []
+        try:
+            with requests.post(url, json={"content": content}, headers=headers, stream=True, timeout=30) as response:
+                if response.status_code != 200:
+                    print(f"❌ Failed - Expected 200, got {response.status_code}")
+                    return False, events
+                event = None
+                for line in response.iter_lines(decode_unicode=True):
+                    if line.startswith("event:"):
+                        event = line[len("event:"):].strip()
+                    elif line.startswith("data:"):
+                        events.append((event, json.loads(line[len("data:"):])))
+        except Exception as e:
+            print(f"❌ Failed - Error: {str(e)}")
+            return False, events
+
+        names = [name for name, _ in events]
+        print(f"   Events: {names}")
+        if not names or names[-1] != "message" or "analysis" not in names[:-1]:
+            print("   ❌ FAILED - Expected analysis events followed by a single message event")
+            return False, events
+        if not any("is_flagged" in data for name, data in events if name == "analysis"):
+            print("   ❌ FAILED - No analysis event carried is_flagged")
+            return False, events
+        message = events[-1][1]
+        if not message.get('id') or not message.get('is_flagged'):
+            print(f"   ❌ FAILED - Stored message should be flagged: {message}")
+            return False, events
+        self.tests_passed += 1
+        print(f"✅ Passed - Streamed {len(events) - 1} analysis events, then the stored message")
+        return True, events
+
     def test_get_messages(self):
         """Test retrieving all messages"""
         success, response = self.run_test("Get All Messages", "GET", "messages", 200)
@@ -124,6 +166,35 @@ class HarassmentDetectionAPITester:
             print(f"   Retrieved {message_count} messages")
         return success, response
 
+    def test_message_pagination(self, page_size=3):
+        """Test that consecutive pages of messages neither overlap nor skip any"""
+        success, everything = self.run_test(
+            "Get Messages Unpaged", "GET", "messages", 200, params={"limit": page_size * 2}
+        )
+        if not success:
+            return False
+        success, first = self.run_test(
+            "Get First Page", "GET", "messages", 200, params={"limit": page_size}
+        )
+        if not success or not first:
+            return False
+        last = first[-1]
+        success, second = self.run_test(
+            "Get Second Page", "GET", "messages", 200,
+            params={"limit": page_size, "before": last['timestamp'], "before_id": last['id']}
+        )
+        if not success:
+            return False
+
+        self.tests_run += 1
+        paged_ids = [msg['id'] for msg in first + second]
+        if paged_ids == [msg['id'] for msg in everything]:
+            self.tests_passed += 1
+            print(f"   ✅ Two pages of {page_size} match one page of {page_size * 2}")
+            return True
+        print(f"   ❌ FAILED - Pages returned {paged_ids}, expected {[msg['id'] for msg in everything]}")
+        return False
+
     def test_analytics(self):
         """Test analytics endpoint"""
         success, response = self.run_test("Get Analytics", "GET", "analytics", 200)
@@ -219,9 +290,14 @@ def main():
             tester.harassment_accuracy_passed += 1
         time.sleep(2)
     
+    # Streaming responses
+    print("\n📍 PHASE 4c: Streamed Analysis Testing")
+    tester.test_streamed_message()
+    
     # Test 5: Get all messages
     print("\n📍 PHASE 5: Message Retrieval Testing")
     tester.test_get_messages()
+    tester.test_message_pagination()
     
     # Test 6: Analytics
     print("\n📍 PHASE 6: Analytics Testing")
@@ -13,20 +13,58 @@ import {
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL || "";
 const API = BACKEND_URL ? `${BACKEND_URL}/api` : null;
 
+// Messages fetched per page of the chat history
+const PAGE_SIZE = 20;
+
+// Read a server-sent event stream, calling onEvent with each parsed event
+async function readEvents(response, onEvent) {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+
+  for (;;) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    const blocks = buffer.split("\n\n");
+    buffer = blocks.pop();
+    for (const block of blocks) {
+      let event = "message";
+      let data = "";
+      for (const line of block.split("\n")) {
+        if (line.startsWith("event:")) event = line.slice(6).trim();
+        else if (line.startsWith("data:")) data += line.slice(5).trim();
+      }
+      if (data) onEvent({ event, data: JSON.parse(data) });
+    }
+  }
+}
+
 function ChatInterface() {
   const [messages, setMessages] = useState([]);
   const [inputMessage, setInputMessage] = useState("");
   const [isLoading, setIsLoading] = useState(false);
+  const [hasMore, setHasMore] = useState(false);
 
   useEffect(() => {
     loadMessages();
   }, []);
 
-  const loadMessages = async () => {
+  // Loads the newest page, or the page after `last` when given
+  const loadMessages = async (last) => {
     if (!API) return; // Skip in static preview
     try {
-      const response = await axios.get(`${API}/messages`);
-      setMessages(response.data);
+      const params = { limit: PAGE_SIZE };
+      if (last) {
+        params.before = last.timestamp;
+        params.before_id = last.id;
+      }
+      const response = await axios.get(`${API}/messages`, { params });
+      setMessages((current) =>
+        last ? [...current, ...response.data] : response.data
+      );
+      setHasMore(response.data.length === PAGE_SIZE);
     } catch (err) {
       console.error("Failed to load messages:", err);
     }
@@ -43,18 +81,35 @@ function ChatInterface() {
     }
 
     try {
-      const response = await axios.post(`${API}/messages`, {
-        content: inputMessage.trim(),
+      // Ask for server-sent events so the verdict shows up while the
+      // analysis is still being generated
+      const response = await fetch(`${API}/messages`, {
+        method: "POST",
+        headers: {
+          "Content-Type": "application/json",
+          Accept: "text/event-stream",
+        },
+        body: JSON.stringify({ content: inputMessage.trim() }),
       });
-
-      setMessages([response.data, ...messages]);
-      setInputMessage("");
-
-      if (response.data.is_abusive) {
-        toast.error("⚠️ Harassment detected");
-      } else {
-        toast.success("✅ Message is safe");
+      if (!response.ok) {
+        throw new Error(`Request failed with status ${response.status}`);
       }
+
+      let verdictShown = false;
+      await readEvents(response, ({ event, data }) => {
+        if (!verdictShown && "is_flagged" in data) {
+          verdictShown = true;
+          if (data.is_flagged) {
+            toast.error("⚠️ Harassment detected");
+          } else {
+            toast.success("✅ Message is safe");
+          }
+        }
+        if (event === "message") {
+          setMessages((current) => [data, ...current]);
+          setInputMessage("");
+        }
+      });
     } catch (err) {
       console.error("Failed to send message:", err);
       toast.error("Failed to send message");
@@ -100,6 +155,15 @@ function ChatInterface() {
           </div>
         ))}
       </div>
+
+      {hasMore && (
+        <button
+          onClick={() => loadMessages(messages[messages.length - 1])}
+          className="w-full mt-4 py-2 rounded-xl text-blue-600 hover:bg-blue-50"
+        >
+          Load more
+        </button>
+      )}
     </div>
   );
 }
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# server.py is run from backend/ rather than installed as a package
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
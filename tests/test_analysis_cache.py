@@ -0,0 +1,83 @@
+import asyncio
+from collections import OrderedDict
+
+import pytest
+
+import server
+
+FLAGGED = {
+    "is_flagged": True,
+    "safety_score": 0.2,
+    "harassment_type": "threats",
+    "flagged_reason": "Threatens violence"
+}
+
+
+class FailingCollection:
+    async def find_one(self, *args, **kwargs):
+        raise ConnectionError("mongo is down")
+
+    async def update_one(self, *args, **kwargs):
+        raise ConnectionError("mongo is down")
+
+
+class FailingDatabase:
+    analysis_cache = FailingCollection()
+
+
+class FakeBatcher:
+    def __init__(self, result):
+        self.result = result
+        self.submitted = []
+
+    async def submit(self, item):
+        self.submitted.append(item)
+        return dict(self.result)
+
+
+@pytest.fixture
+def mongo_down(monkeypatch):
+    monkeypatch.setattr(server, "db", FailingDatabase())
+    monkeypatch.setattr(server, "_analysis_cache", OrderedDict())
+    monkeypatch.setattr(server, "local_classifier", None)
+    monkeypatch.setattr(server.app.state, "pending_writes", set())
+
+
+async def _analyze_and_flush(content):
+    result = await server.analyze_message_harassment(content)
+    await asyncio.gather(*server.app.state.pending_writes, return_exceptions=True)
+    return result
+
+
+def test_unreadable_cache_is_a_miss(mongo_down):
+    assert asyncio.run(server.get_cached_analysis("some-key")) is None
+
+
+def test_llm_still_runs_when_cache_read_fails(mongo_down, monkeypatch):
+    batcher = FakeBatcher(FLAGGED)
+    monkeypatch.setattr(server, "llm_batcher", batcher)
+
+    result = asyncio.run(_analyze_and_flush("I know where you live"))
+
+    assert batcher.submitted == ["I know where you live"]
+    assert result == FLAGGED
+
+
+def test_failed_cache_write_keeps_verdict(mongo_down, monkeypatch):
+    monkeypatch.setattr(server, "llm_batcher", FakeBatcher(FLAGGED))
+
+    result = asyncio.run(_analyze_and_flush("I know where you live"))
+
+    assert result["is_flagged"] is True
+    assert not server.app.state.pending_writes
+
+
+def test_memory_cache_serves_repeats(mongo_down, monkeypatch):
+    batcher = FakeBatcher(FLAGGED)
+    monkeypatch.setattr(server, "llm_batcher", batcher)
+
+    asyncio.run(_analyze_and_flush("I know where you live"))
+    repeat = asyncio.run(_analyze_and_flush("  I KNOW where you live "))
+
+    assert len(batcher.submitted) == 1
+    assert repeat == FLAGGED
@@ -0,0 +1,164 @@
+import asyncio
+from types import SimpleNamespace
+
+import orjson
+import pytest
+
+import server
+
+
+class BrokenStream:
+    """Streams the first pieces of a reply, then fails like a dropped connection"""
+
+    def __init__(self, pieces, breaks=True):
+        self.pieces = pieces
+        self.breaks = breaks
+
+    def __aiter__(self):
+        return self._chunks()
+
+    async def _chunks(self):
+        for piece in self.pieces:
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))])
+            await asyncio.sleep(0)
+        if self.breaks:
+            raise ConnectionError("stream dropped")
+
+    async def close(self):
+        pass
+
+
+class RecordingWriter:
+    def __init__(self):
+        self.stored = []
+
+    async def submit(self, message):
+        self.stored.append(message)
+
+
+@pytest.fixture
+def streaming(monkeypatch):
+    async def nothing_local(content, normalized):
+        return None
+
+    writer = RecordingWriter()
+    monkeypatch.setattr(server, "analyze_without_llm", nothing_local)
+    monkeypatch.setattr(server, "message_writer", writer)
+    monkeypatch.setattr(server.app.state, "pending_writes", set())
+
+    def reply_with(pieces, breaks=True):
+        async def create(**kwargs):
+            return BrokenStream(pieces, breaks)
+        client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+        monkeypatch.setattr(server, "openai_client", client)
+
+    return SimpleNamespace(writer=writer, reply_with=reply_with)
+
+
+def parse_events(chunks):
+    events = []
+    for chunk in chunks:
+        name, data = chunk.decode().strip().split("\n")
+        events.append((name[len("event: "):], orjson.loads(data[len("data: "):])))
+    return events
+
+
+async def drain():
+    while server.app.state.pending_writes:
+        await asyncio.gather(*server.app.state.pending_writes, return_exceptions=True)
+
+
+def test_failed_stream_keeps_verdict_already_sent(streaming):
+    streaming.reply_with(['{"is_flagged": tr', 'ue, "safety_score": 0.1, '])
+
+    async def scenario():
+        chunks = [chunk async for chunk in server.message_events("meet me outside")]
+        await drain()
+        return parse_events(chunks)
+
+    events = asyncio.run(scenario())
+
+    assert events[0] == ("analysis", {"is_flagged": True})
+    name, message = events[-1]
+    assert name == "message"
+    assert message["is_flagged"] is True
+    assert streaming.writer.stored[0]["is_flagged"] is True
+
+
+def test_failure_before_any_verdict_falls_back_to_safe(streaming):
+    streaming.reply_with(['{"is_fl'])
+
+    async def scenario():
+        chunks = [chunk async for chunk in server.message_events("hello")]
+        await drain()
+        return parse_events(chunks)
+
+    events = asyncio.run(scenario())
+
+    assert [name for name, _ in events] == ["analysis", "message"]
+    assert events[-1][1]["is_flagged"] is False
+
+
+def test_message_is_stored_when_client_disconnects(streaming):
+    streaming.reply_with(['{"is_flagged": true, ', '"safety_score": 0.1, ', '"harassment_type": "threats"'])
+
+    async def scenario():
+        events = server.message_events("meet me outside")
+        await events.__anext__()
+        await events.aclose()
+        await drain()
+
+    asyncio.run(scenario())
+
+    assert len(streaming.writer.stored) == 1
+    assert streaming.writer.stored[0]["content"] == "meet me outside"
+    assert streaming.writer.stored[0]["is_flagged"] is True
+
+
+def test_streamed_verdict_missing_fields_is_not_cached(streaming, monkeypatch):
+    # A category outside the expected spelling never matches the field scan
+    streaming.reply_with(
+        ['{"is_flagged": true, "safety_score": 0.2, ', '"harassment_type": "Threats", ', '"flagged_reason": "Threat"}'],
+        breaks=False
+    )
+    cached = []
+    monkeypatch.setattr(server, "cache_analysis", lambda key, result: cached.append(result))
+
+    async def scenario():
+        chunks = [chunk async for chunk in server.message_events("meet me outside")]
+        await drain()
+        return parse_events(chunks)
+
+    events = asyncio.run(scenario())
+
+    assert events[-1][1]["is_flagged"] is True
+    assert cached == []
+
+
+def test_shutdown_waits_for_analyses_in_a_batch_window(streaming, monkeypatch):
+    async def flag_all(contents):
+        return [{"is_flagged": True, "safety_score": 0.1, "harassment_type": "threats", "flagged_reason": "Threat"}
+                for _ in contents]
+
+    async def store_all(messages):
+        stored.extend(messages)
+        return [None] * len(messages)
+
+    stored = []
+    monkeypatch.setattr(server, "openai_client", None)
+    monkeypatch.setattr(server, "cache_analysis", lambda key, result: None)
+    monkeypatch.setattr(server, "client", SimpleNamespace(close=lambda: None))
+
+    async def scenario():
+        monkeypatch.setattr(server, "llm_batcher", server.MicroBatcher(flag_all, 8, 0.05))
+        monkeypatch.setattr(server, "classifier_batcher", server.MicroBatcher(flag_all, 8, 0.05))
+        monkeypatch.setattr(server, "message_writer", server.MicroBatcher(store_all, 8, 0.01))
+        server.run_in_background(server.analyze_and_store_streaming("I will hurt you", asyncio.Queue()))
+        # Let the analysis reach the batcher, then shut down while it waits for more
+        await asyncio.sleep(0.01)
+        await server.shutdown_db_client()
+
+    asyncio.run(scenario())
+
+    assert [message["content"] for message in stored] == ["I will hurt you"]
+    assert stored[0]["is_flagged"] is True
@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+from server import MicroBatcher
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, timeout=5))
+
+
+def test_batches_are_capped_and_results_scattered():
+    batches = []
+
+    async def handler(items):
+        batches.append(list(items))
+        return [item * 2 for item in items]
+
+    async def scenario():
+        batcher = MicroBatcher(handler, max_batch_size=3, max_wait=0.05)
+        results = await asyncio.gather(*(batcher.submit(i) for i in range(7)))
+        await batcher.close()
+        return results
+
+    assert run(scenario()) == [0, 2, 4, 6, 8, 10, 12]
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+
+
+def test_handler_error_reaches_every_waiter():
+    async def handler(items):
+        raise ConnectionError("upstream down")
+
+    async def scenario():
+        batcher = MicroBatcher(handler, max_batch_size=4, max_wait=0.01)
+        results = await asyncio.gather(*(batcher.submit(i) for i in range(3)), return_exceptions=True)
+        await batcher.close()
+        return results
+
+    results = run(scenario())
+    assert all(isinstance(result, ConnectionError) for result in results)
+
+
+def test_short_result_list_fails_instead_of_hanging():
+    async def handler(items):
+        return [1]
+
+    async def scenario():
+        batcher = MicroBatcher(handler, max_batch_size=4, max_wait=0.01)
+        results = await asyncio.gather(batcher.submit("a"), batcher.submit("b"), return_exceptions=True)
+        await batcher.close()
+        return results
+
+    results = run(scenario())
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_returned_exceptions_fail_only_their_item():
+    async def handler(items):
+        return [ValueError(item) if item == "bad" else item.upper() for item in items]
+
+    async def scenario():
+        batcher = MicroBatcher(handler, max_batch_size=4, max_wait=0.01)
+        results = await asyncio.gather(batcher.submit("ok"), batcher.submit("bad"), return_exceptions=True)
+        await batcher.close()
+        return results
+
+    ok, bad = run(scenario())
+    assert ok == "OK"
+    assert isinstance(bad, ValueError)
+
+
+def test_close_fails_batch_being_collected():
+    async def handler(items):
+        return items
+
+    async def scenario():
+        batcher = MicroBatcher(handler, max_batch_size=10, max_wait=10)
+        waiters = [asyncio.create_task(batcher.submit(i)) for i in range(2)]
+        await asyncio.sleep(0.01)
+        await batcher.close()
+        return await asyncio.gather(*waiters, return_exceptions=True)
+
+    results = run(scenario())
+    assert all(isinstance(result, RuntimeError) for result in results)
@@ -0,0 +1,199 @@
+import asyncio
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import pytest
+
+import server
+
+
+class FakeStream:
+    def __init__(self, pieces):
+        self.pieces = pieces
+        self.closed = False
+
+    def __aiter__(self):
+        return self._chunks()
+
+    async def _chunks(self):
+        for piece in self.pieces:
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))])
+
+    async def close(self):
+        self.closed = True
+
+
+def fake_openai(stream):
+    async def create(**kwargs):
+        return stream
+    return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+def split(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+async def collect_fields(content="hello"):
+    return [item async for item in server.stream_analysis_fields(content)]
+
+
+REPLY = (
+    '{\n    "is_flagged": true,\n    "safety_score": 0.25,\n'
+    '    "harassment_type": "threats",\n'
+    '    "flagged_reason": "Says \\"I will hurt you\\" to the reader"\n}'
+)
+
+
+@pytest.mark.parametrize("size", [1, 3, 7, len(REPLY)])
+def test_fields_survive_any_chunking(monkeypatch, size):
+    monkeypatch.setattr(server, "openai_client", fake_openai(FakeStream(split(REPLY, size))))
+
+    fields = dict(asyncio.run(collect_fields()))
+
+    assert fields == {
+        "is_flagged": True,
+        "safety_score": 0.25,
+        "harassment_type": "threats",
+        "flagged_reason": 'Says "I will hurt you" to the reader'
+    }
+
+
+def test_fields_arrive_in_reply_order(monkeypatch):
+    monkeypatch.setattr(server, "openai_client", fake_openai(FakeStream(split(REPLY, 2))))
+
+    fields = [field for field, _ in asyncio.run(collect_fields())]
+
+    assert fields == ["is_flagged", "safety_score", "harassment_type", "flagged_reason"]
+
+
+def test_integer_safety_score_and_nulls(monkeypatch):
+    reply = '{"is_flagged": false, "safety_score": 1, "harassment_type": null, "flagged_reason": null}'
+    monkeypatch.setattr(server, "openai_client", fake_openai(FakeStream(split(reply, 4))))
+
+    fields = dict(asyncio.run(collect_fields()))
+
+    assert fields == {"is_flagged": False, "safety_score": 1.0, "harassment_type": None, "flagged_reason": None}
+
+
+def test_partial_values_are_not_emitted():
+    partial = '{"is_flagged": true, "safety_score": 0.'
+    assert server._STREAM_FIELD_RES["safety_score"].search(partial) is None
+
+    partial = '{"flagged_reason": "ends with an escaped quote \\"'
+    assert server._STREAM_FIELD_RES["flagged_reason"].search(partial) is None
+
+
+def test_escaped_backslash_before_closing_quote():
+    match = server._STREAM_FIELD_RES["flagged_reason"].search('"flagged_reason": "path C:\\\\"}')
+    assert server._parse_stream_field("flagged_reason", match) == "path C:\\"
+
+
+class RecordingCollection:
+    def __init__(self):
+        self.upserts = []
+
+    async def find_one(self, *args, **kwargs):
+        return None
+
+    async def update_one(self, query, update, upsert=False):
+        self.upserts.append(update["$set"]["result"])
+
+
+@pytest.fixture
+def analysis_cache(monkeypatch):
+    cache = OrderedDict()
+    monkeypatch.setattr(server, "_analysis_cache", cache)
+    monkeypatch.setattr(server, "db", SimpleNamespace(analysis_cache=RecordingCollection()))
+    monkeypatch.setattr(server, "local_classifier", None)
+    monkeypatch.setattr(server.app.state, "pending_writes", set())
+    return cache
+
+
+async def drain_background():
+    while server.app.state.pending_writes:
+        await asyncio.gather(*server.app.state.pending_writes, return_exceptions=True)
+
+
+def test_stream_analysis_returns_early_and_caches_once_whole(monkeypatch, analysis_cache):
+    stream = FakeStream(split(REPLY, 5))
+    monkeypatch.setattr(server, "openai_client", fake_openai(stream))
+
+    async def scenario():
+        result = await server.stream_analysis("Hello ")
+        assert not analysis_cache
+        await drain_background()
+        return result
+
+    result = asyncio.run(scenario())
+
+    assert result == {"is_flagged": True, "safety_score": 0.25, "harassment_type": "threats"}
+    assert list(analysis_cache.values()) == [{
+        "is_flagged": True,
+        "safety_score": 0.25,
+        "harassment_type": "threats",
+        "flagged_reason": 'Says "I will hurt you" to the reader'
+    }]
+    assert server.db.analysis_cache.upserts == list(analysis_cache.values())
+    assert analysis_cache.get(server._analysis_cache_key("hello"))
+    assert stream.closed
+
+
+def test_safe_stream_verdict_is_complete_without_the_reason(monkeypatch):
+    reply = '{"is_flagged": false, "safety_score": 1.0, "harassment_type": null, "flagged_reason": null}'
+    stream = FakeStream(split(reply, 3))
+    monkeypatch.setattr(server, "openai_client", fake_openai(stream))
+
+    result = asyncio.run(server.stream_analysis("hello"))
+
+    assert result == {"is_flagged": False, "safety_score": 1.0, "harassment_type": None, "flagged_reason": None}
+    assert stream.closed
+
+
+@pytest.mark.parametrize("reply", [REPLY, '{"is_flagged": false, "safety_score": 1.0, "harassment_type": null}'])
+def test_repeated_message_skips_the_llm(monkeypatch, analysis_cache, reply):
+    streams = []
+
+    async def create(**kwargs):
+        streams.append(FakeStream(split(reply, 4)))
+        return streams[-1]
+    monkeypatch.setattr(server, "openai_client", SimpleNamespace(
+        chat=SimpleNamespace(completions=SimpleNamespace(create=create))
+    ))
+
+    async def scenario():
+        batcher = server.MicroBatcher(server.analyze_batch_with_llm, server.LLM_BATCH_SIZE, 0)
+        monkeypatch.setattr(server, "llm_batcher", batcher)
+        try:
+            results = []
+            for _ in range(3):
+                results.append(await server.analyze_message_harassment("see you soon"))
+                await drain_background()
+            return results
+        finally:
+            await batcher.close()
+
+    results = asyncio.run(scenario())
+
+    assert len(streams) == 1
+    assert results[0]["is_flagged"] == results[2]["is_flagged"]
+    assert "flagged_reason" in results[2]
+
+
+def test_early_stopped_results_are_not_cached(monkeypatch):
+    class PartialBatcher:
+        async def submit(self, item):
+            return {"is_flagged": True, "safety_score": 0.25, "harassment_type": "threats"}
+
+    cache = OrderedDict()
+    monkeypatch.setattr(server, "_analysis_cache", cache)
+    monkeypatch.setattr(server, "local_classifier", None)
+    monkeypatch.setattr(server, "llm_batcher", PartialBatcher())
+
+    async def missing_from_mongo(key):
+        return None
+    monkeypatch.setattr(server, "get_cached_analysis", missing_from_mongo)
+
+    result = asyncio.run(server.analyze_message_harassment("meet me outside"))
+
+    assert result["is_flagged"] is True
+    assert not cache